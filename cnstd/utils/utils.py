@@ -18,16 +18,23 @@
 # under the License.
 
 import os
+import math
 import hashlib
+import hmac
+import mmap
 import requests
-from pathlib import Path
 from typing import Tuple, Union, List, Dict, Any
 import logging
 import platform
+import pickle
 import zipfile
+import functools
 from functools import cmp_to_key
 import shutil
 import tempfile
+import threading
+import uuid
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
 
 from tqdm import tqdm
 import cv2
@@ -56,10 +63,10 @@ def set_logger(log_file=None, log_level=logging.INFO, log_file_level=logging.NOT
     console_handler.setFormatter(log_format)
     logger.handlers = [console_handler]
     if log_file and log_file != '':
-        if not Path(log_file).parent.exists():
-            os.makedirs(Path(log_file).parent)
-        if isinstance(log_file, Path):
-            log_file = str(log_file)
+        log_file = os.fspath(log_file)
+        log_dir = os.path.dirname(log_file)
+        if log_dir:
+            os.makedirs(log_dir, exist_ok=True)
         file_handler = logging.FileHandler(log_file)
         file_handler.setLevel(log_file_level)
         file_handler.setFormatter(log_format)
@@ -116,7 +123,25 @@ def check_model_name(model_name):
     assert model_name in MODEL_CONFIGS
 
 
-def check_sha1(filename, sha1_hash):
+def _io_chunk_size(chunk_size, env_name, default):
+    """Chunk size given by the caller, or by env `env_name`, or `default`.
+    It can be tuned per deployment (HDD vs. NVMe, slow vs. fast links).
+    """
+    if chunk_size is None:
+        chunk_size = os.getenv(env_name, default)
+    try:
+        value = int(chunk_size)
+    except (TypeError, ValueError):
+        value = 0
+    if value <= 0:
+        raise ValueError(
+            'chunk size must be a positive integer, got %r '
+            '(set by argument `chunk_size` or env `%s`)' % (chunk_size, env_name)
+        )
+    return value
+
+
+def check_sha1(filename, sha1_hash, chunk_size=None):
     """Check whether the sha1 hash of the file content matches the expected hash.
     Parameters
     ----------
@@ -124,25 +149,206 @@ def check_sha1(filename, sha1_hash):
         Path to the file.
     sha1_hash : str
         Expected sha1 hash in hexadecimal digits.
+    chunk_size : int, optional
+        Bytes read per iteration. If it is given, or env `CNSTD_HASH_CHUNK` is set,
+        the file is always hashed chunk by chunk; otherwise the fastest available
+        way (mmap, or `hashlib.file_digest`) is used, with 16 MiB chunks as the last resort.
+        The HTTP chunk size of `download()` (env `CNSTD_IO_CHUNK`) doesn't apply here.
     Returns
     -------
     bool
         Whether the file content matches the expected hash.
     """
-    sha1 = hashlib.sha1()
-    with open(filename, 'rb') as f:
-        while True:
-            data = f.read(1048576)
-            if not data:
-                break
-            sha1.update(data)
+    chunked = chunk_size is not None or 'CNSTD_HASH_CHUNK' in os.environ
+    if not chunked and 0 < os.path.getsize(filename) < _available_memory() // 2:
+        # hash the whole mapped file in one call, without any per-chunk copies
+        with open(filename, 'rb') as f, mmap.mmap(
+            f.fileno(), 0, access=mmap.ACCESS_READ
+        ) as mm:
+            if hasattr(mmap, 'MADV_SEQUENTIAL'):
+                mm.madvise(mmap.MADV_SEQUENTIAL)
+            sha1_file = hashlib.sha1(mm).hexdigest()
+    elif not chunked and hasattr(hashlib, 'file_digest'):  # Python >= 3.11
+        with open(filename, 'rb') as f:
+            _advise_sequential(f.fileno())
+            sha1_file = hashlib.file_digest(f, 'sha1').hexdigest()
+    else:
+        sha1 = hashlib.sha1()
+        # reuse one large buffer instead of allocating a new bytes object per chunk
+        buf = bytearray(_io_chunk_size(chunk_size, 'CNSTD_HASH_CHUNK', 16 << 20))
+        mv = memoryview(buf)
+        with open(filename, 'rb', buffering=0) as f:
+            _advise_sequential(f.fileno())
+            while True:
+                n = f.readinto(buf)
+                if not n:
+                    break
+                sha1.update(mv[:n])
+        sha1_file = sha1.hexdigest()
+
+    return _match_sha1(sha1_file, sha1_hash)
+
+
+@functools.lru_cache(maxsize=128)
+def _check_sha1_cached(filename, ino, size, mtime_ns, ctime_ns, sha1_hash):
+    # the stat fields are only part of the cache key: they change when the file does.
+    # `ino` and `ctime_ns` also catch a replacement that keeps size and mtime
+    # (e.g. `cp -p`, `rsync -t` or `shutil.copy2`), as neither can be copied over
+    return check_sha1(filename, sha1_hash)
+
+
+def _check_sha1_if_changed(filename, sha1_hash):
+    """Same as `check_sha1()`, but skips rehashing a file that is unchanged since the last call."""
+    stat = os.stat(filename)
+    return _check_sha1_cached(
+        os.path.abspath(filename),
+        stat.st_ino,
+        stat.st_size,
+        stat.st_mtime_ns,
+        stat.st_ctime_ns,
+        sha1_hash,
+    )
+
 
-    sha1_file = sha1.hexdigest()
+def _match_sha1(sha1_file, sha1_hash):
     l = min(len(sha1_file), len(sha1_hash))
-    return sha1.hexdigest()[0:l] == sha1_hash[0:l]
+    return hmac.compare_digest(sha1_file[0:l], sha1_hash[0:l])
+
+
+def _advise_sequential(fd):
+    """Hint the kernel to read ahead aggressively; no-op where unsupported (Windows)."""
+    if hasattr(os, 'posix_fadvise'):
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+
+def _available_memory():
+    """Available physical memory in bytes, including reclaimable page cache on Linux.
+    Returns 0 if it can't be determined, e.g. on macOS and Windows.
+    """
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024  # in kB
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        # only free pages, without the page cache
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return 0
+
 
+def _sequential_download(url, fname, chunk_size, sha1=None):
+    """Download `url` into `fname` in a single stream.
+    If `sha1` is given, it is updated with the downloaded content on the fly.
+    """
+    r = requests.get(url, stream=True)
+    if r.status_code != 200:
+        raise RuntimeError("Failed downloading url %s" % url)
+    total_length = r.headers.get('content-length')
+    with open(fname, 'wb') as f:
+        if total_length is None:  # no content length header
+            for chunk in r.iter_content(chunk_size=chunk_size):
+                if chunk:  # filter out keep-alive new chunks
+                    f.write(chunk)
+                    if sha1 is not None:
+                        sha1.update(chunk)
+        else:
+            with tqdm(
+                total=int(total_length), unit='B', unit_scale=True, dynamic_ncols=True
+            ) as pbar:
+                for chunk in r.iter_content(chunk_size=chunk_size):
+                    f.write(chunk)
+                    if sha1 is not None:
+                        sha1.update(chunk)
+                    pbar.update(len(chunk))
+
+
+def _ranged_download(url, fname, total, chunk_size, n=8):
+    """Download `url` into `fname` with `n` parallel HTTP Range requests.
+    Each worker writes its own disjoint byte range into a preallocated temporary file,
+    which is moved to `fname` only after all the ranges are downloaded.
+    """
+    part_size = max(math.ceil(total / n), 1)
+    lock = threading.Lock()
+    failed = threading.Event()
+    # unique, so a retry doesn't clash with the cleanup of a previous failed attempt
+    tmp_fname = '%s.%s.part' % (fname, uuid.uuid4().hex[:8])
+    fd = os.open(tmp_fname, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+
+    def _cleanup(running=()):
+        wait(running)  # workers may still write to `fd` until they notice `failed`
+        os.close(fd)
+        os.remove(tmp_fname)
 
-def download(url, path=None, download_source='CN', overwrite=False, sha1_hash=None):
+    try:
+        os.ftruncate(fd, total)
+    except BaseException:
+        _cleanup()
+        raise
+
+    with tqdm(total=total, unit='B', unit_scale=True, dynamic_ncols=True) as pbar:
+
+        def _fetch(lo, hi):
+            r = requests.get(
+                url, headers={'Range': 'bytes=%d-%d' % (lo, hi - 1)}, stream=True
+            )
+            if r.status_code != 206:
+                raise RuntimeError("Failed downloading url %s" % url)
+            offset = lo
+            for chunk in r.iter_content(chunk_size=chunk_size):
+                if failed.is_set():  # another range failed, stop early
+                    return
+                view = memoryview(chunk)
+                while view:  # `pwrite` may write less than requested
+                    written = os.pwrite(fd, view, offset)
+                    offset += written
+                    view = view[written:]
+                with lock:
+                    pbar.update(len(chunk))
+            if offset != hi:
+                raise RuntimeError(
+                    "Incomplete download of bytes %d-%d from url %s"
+                    % (lo, hi - 1, url)
+                )
+
+        executor = ThreadPoolExecutor(max_workers=n)
+        futures = [
+            executor.submit(_fetch, lo, min(lo + part_size, total))
+            for lo in range(0, total, part_size)
+        ]
+        try:
+            # fail as soon as any range fails, not in submission order
+            done, running = wait(futures, return_when=FIRST_EXCEPTION)
+        except BaseException:  # e.g. KeyboardInterrupt
+            failed.set()
+            executor.shutdown(wait=False)
+            threading.Thread(target=_cleanup, args=(futures,), daemon=True).start()
+            raise
+        executor.shutdown(wait=False)
+        error = next((future.exception() for future in done if future.exception()), None)
+        if error is not None:
+            failed.set()  # tell the running workers to stop early
+            if running:
+                # don't wait for slow ranges; remove the file once they have stopped
+                threading.Thread(target=_cleanup, args=(running,), daemon=True).start()
+            else:
+                _cleanup()
+            raise error
+
+    os.close(fd)
+    os.replace(tmp_fname, fname)
+
+
+def download(
+    url,
+    path=None,
+    download_source='CN',
+    overwrite=False,
+    sha1_hash=None,
+    chunk_size=None,
+):
     """Download a given URL
     Parameters
     ----------
@@ -157,6 +363,10 @@ def download(url, path=None, download_source='CN', overwrite=False, sha1_hash=No
     sha1_hash : str, optional
         Expected sha1 hash in hexadecimal digits. Will ignore existing file when hash is specified
         but doesn't match.
+    chunk_size : int, optional
+        Bytes per streamed HTTP chunk. Defaults to env `CNSTD_IO_CHUNK`, or 1 MiB.
+        It only applies to downloading; hashing is tuned by env `CNSTD_HASH_CHUNK`,
+        see `check_sha1()`.
     Returns
     -------
     str
@@ -174,34 +384,39 @@ def download(url, path=None, download_source='CN', overwrite=False, sha1_hash=No
     if (
         overwrite
         or not os.path.exists(fname)
-        or (sha1_hash and not check_sha1(fname, sha1_hash))
+        or (sha1_hash and not _check_sha1_if_changed(fname, sha1_hash))
     ):
-        dirname = os.path.dirname(os.path.abspath(os.path.expanduser(fname)))
-        if not os.path.exists(dirname):
-            os.makedirs(dirname)
+        # `fname` is either taken from `url` or has been expanded above
+        os.makedirs(os.path.dirname(os.path.abspath(fname)), exist_ok=True)
 
+        chunk_size = _io_chunk_size(chunk_size, 'CNSTD_IO_CHUNK', 1 << 20)
+        sha1_file = None  # set when the hash is computed during downloading
         if download_source == 'CN' and 'cn_oss' in url:
             oss_url = url['cn_oss'] + url['filename']
             logger.info('Downloading %s from %s...' % (fname, oss_url))
-            r = requests.get(oss_url, stream=True)
-            if r.status_code != 200:
-                raise RuntimeError("Failed downloading url %s" % oss_url)
-            total_length = r.headers.get('content-length')
-            with open(fname, 'wb') as f:
-                if total_length is None:  # no content length header
-                    for chunk in r.iter_content(chunk_size=1024):
-                        if chunk:  # filter out keep-alive new chunks
-                            f.write(chunk)
-                else:
-                    total_length = int(total_length)
-                    for chunk in tqdm(
-                        r.iter_content(chunk_size=1024),
-                        total=int(total_length / 1024.0 + 0.5),
-                        unit='KB',
-                        unit_scale=False,
-                        dynamic_ncols=True,
+            ranged = False
+            if hasattr(os, 'pwrite'):
+                try:
+                    head = requests.head(oss_url, allow_redirects=True)
+                    total_length = head.headers.get('content-length')
+                    if (
+                        head.status_code == 200
+                        and total_length is not None
+                        and head.headers.get('accept-ranges', '').lower() == 'bytes'
                     ):
-                        f.write(chunk)
+                        _ranged_download(oss_url, fname, int(total_length), chunk_size)
+                        ranged = True
+                except (RuntimeError, requests.RequestException) as e:
+                    # e.g. a proxy ignoring `Range`, or a transient error in one of the ranges
+                    logger.warning(
+                        'Failed to download %s with parallel ranges (%s), '
+                        'retrying in a single stream' % (oss_url, e)
+                    )
+            if not ranged:
+                sha1 = hashlib.sha1() if sha1_hash else None
+                _sequential_download(oss_url, fname, chunk_size, sha1)
+                if sha1 is not None:
+                    sha1_file = sha1.hexdigest()
         else:
             HF_TOKEN = os.environ.get('HF_TOKEN')
             for hf_endpoint in HF_ENDPOINT_LIST:
@@ -228,7 +443,11 @@ def download(url, path=None, download_source='CN', overwrite=False, sha1_hash=No
                         % (fname, hf_endpoint, url["repo_id"])
                     )
 
-        if sha1_hash and not check_sha1(fname, sha1_hash):
+        if sha1_hash and sha1_file is None:
+            matched = _check_sha1_if_changed(fname, sha1_hash)
+        else:
+            matched = not sha1_hash or _match_sha1(sha1_file, sha1_hash)
+        if not matched:
             raise UserWarning(
                 'File {} is downloaded but the content hash does not match. '
                 'The repo may be outdated or download may be incomplete. '
@@ -238,6 +457,47 @@ def download(url, path=None, download_source='CN', overwrite=False, sha1_hash=No
     return fname
 
 
+def _extract_zip(zip_file_path, target_dir):
+    """Extract the entries of a zip file in parallel (zlib releases the GIL)."""
+    with zipfile.ZipFile(zip_file_path) as zf:
+        members = zf.infolist()
+    # create the directories first, so that workers don't race on `os.makedirs`
+    target_dir = os.path.abspath(target_dir)
+    for member in members:
+        sub_dir = member.filename if member.is_dir() else os.path.dirname(member.filename)
+        sub_dir = os.path.normpath(os.path.join(target_dir, sub_dir))
+        if os.path.commonpath([target_dir, sub_dir]) == target_dir:
+            os.makedirs(sub_dir, exist_ok=True)
+    files = [member for member in members if not member.is_dir()]
+    if len(files) <= 1:
+        with zipfile.ZipFile(zip_file_path) as zf:
+            for member in files:
+                zf.extract(member, target_dir)
+        return
+
+    # ZipFile is not thread-safe, so every worker thread opens its own handle once
+    local = threading.local()
+    handles = []
+    handles_lock = threading.Lock()
+
+    def _extract_one(member):
+        zf = getattr(local, 'zf', None)
+        if zf is None:
+            zf = local.zf = zipfile.ZipFile(zip_file_path)
+            with handles_lock:
+                handles.append(zf)
+        zf.extract(member, target_dir)
+
+    try:
+        with ThreadPoolExecutor(
+            max_workers=min(len(files), os.cpu_count() or 1)
+        ) as executor:
+            list(executor.map(_extract_one, files))
+    finally:
+        for zf in handles:
+            zf.close()
+
+
 class ModelDownloadingError(Exception):
     pass
 
@@ -280,19 +540,19 @@ def get_model_file(url, model_dir, download_source='CN'):
                 '[CnSTD/CnOCR Doc](https://www.breezedeus.com/cnocr) to manually download the model files.'
             )
             raise ModelDownloadingError(message)
-    with zipfile.ZipFile(zip_file_path) as zf:
-        zf.extractall(par_dir)
+    _extract_zip(zip_file_path, par_dir)
     os.remove(zip_file_path)
 
     return model_dir
 
 
 def read_charset(charset_fp):
-    alphabet = []
     with open(charset_fp, encoding='utf-8') as fp:
-        for line in fp:
-            alphabet.append(line.rstrip('\n'))
-    inv_alph_dict = {_char: idx for idx, _char in enumerate(alphabet)}
+        # not `splitlines()`, which would also split on chars like '\x0c' or '\u2028'
+        alphabet = fp.read().split('\n')
+    if alphabet[-1] == '':
+        alphabet.pop()
+    inv_alph_dict = dict(zip(alphabet, range(len(alphabet))))
     if len(alphabet) != len(inv_alph_dict):
         from collections import Counter
 
@@ -302,7 +562,7 @@ def read_charset(charset_fp):
     return alphabet, inv_alph_dict
 
 
-RGB_MEAN = np.array([122.67891434, 116.66876762, 104.00698793])
+RGB_MEAN = np.array([122.67891434, 116.66876762, 104.00698793], dtype=np.float32)
 
 
 def normalize_img_array(img: np.ndarray, dtype='float32'):
@@ -311,10 +571,10 @@ def normalize_img_array(img: np.ndarray, dtype='float32'):
     :param dtype: resulting dtype
     """
 
-    img = img.astype(dtype)
+    img = img.astype(dtype)  # always a copy, so the in-place ops below are safe
     img_mean = RGB_MEAN.reshape(3, 1, 1) if img.shape[0] == 3 else RGB_MEAN
     img -= img_mean
-    img = img / 255.0
+    img /= 255.0
     # img -= np.array((0.485, 0.456, 0.406))
     # img /= np.array((0.229, 0.224, 0.225))
     return img
@@ -330,8 +590,12 @@ def restore_img(img):
 
     """
     img_mean = RGB_MEAN.reshape(3, 1, 1) if img.shape[0] == 3 else RGB_MEAN
-    img = img * 255 + img_mean
-    return img.clip(0, 255).astype(np.uint8)
+    img = img * 255  # the only temporary array; the ops below work in place
+    # the sum is rounded to float32 before truncation to uint8, so pixels right at
+    # an integer boundary may differ by 1 from a float64 computation
+    img += img_mean
+    np.clip(img, 0, 255, out=img)
+    return img.astype(np.uint8)
 
 
 def read_img(img_fp) -> Image.Image:
@@ -460,10 +724,13 @@ def imread(img_fp) -> np.ndarray:
     """
     try:
         im = cv2.imread(img_fp, cv2.IMREAD_COLOR)  # res: color BGR, shape: [H, W, C]
-        im = cv2.cvtColor(im.astype('float32'), cv2.COLOR_BGR2RGB)
+        im = cv2.cvtColor(im, cv2.COLOR_BGR2RGB, dst=im)  # in place, on uint8
+        # [H, W, C] -> [C, H, W] and uint8 -> float32 in one copy
+        out = np.empty((3,) + im.shape[:2], dtype=np.float32)
+        np.copyto(out, im.transpose((2, 0, 1)))
     except:
-        im = np.asarray(Image.open(img_fp).convert('RGB'))
-    return im.transpose((2, 0, 1))
+        out = np.asarray(Image.open(img_fp).convert('RGB')).transpose((2, 0, 1))
+    return out
 
 
 def imsave(image: np.ndarray, fp, normalized=True):
@@ -477,11 +744,17 @@ def imsave(image: np.ndarray, fp, normalized=True):
     Returns:
 
     """
+    ori_image = image
     if normalized:
         image = restore_img(image)
     if image.dtype != np.uint8:
         image = image.clip(0, 255).astype(np.uint8)
-    image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
+    if image is not ori_image:
+        # a new array owned by this function, so convert it in place
+        image = np.ascontiguousarray(image)
+        image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR, dst=image)
+    else:
+        image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
     cv2.imwrite(fp, image)
 
 
@@ -546,14 +819,43 @@ def get_resized_shape(
     return calibrate(new_hw[0]), calibrate(new_hw[1])
 
 
+def _torch_load_mmap(param_fp, map_location, weights_only):
+    try:
+        # map tensors lazily from the file instead of reading it all into memory
+        return torch.load(
+            param_fp, map_location=map_location, mmap=True, weights_only=weights_only
+        )
+    except RuntimeError as e:
+        if 'mmap can only be used' not in str(e):  # e.g. truncated or corrupt files
+            raise
+        # legacy (non-zip) checkpoints can't be memory-mapped
+        logger.debug('fall back to loading %s without mmap: %s', param_fp, e)
+    return torch.load(param_fp, map_location=map_location, weights_only=weights_only)
+
+
+def _load_checkpoint(param_fp, map_location):
+    try:
+        return _torch_load_mmap(param_fp, map_location, weights_only=True)
+    except TypeError:  # torch < 2.1 doesn't support `mmap`
+        return torch.load(param_fp, map_location=map_location)
+    except pickle.UnpicklingError as e:  # checkpoints storing non-tensor objects
+        logger.warning(
+            'checkpoint %s stores non-tensor objects, loading it with weights_only=False, '
+            'which unpickles arbitrary objects; only load files from trusted sources'
+            % param_fp
+        )
+        logger.debug('weights_only loading of %s failed: %s', param_fp, e)
+    # torch >= 2.6 defaults to `weights_only=True`, which the failure above ruled out
+    return _torch_load_mmap(param_fp, map_location, weights_only=False)
+
+
 def load_model_params(model, param_fp, device='cpu'):
-    checkpoint = torch.load(param_fp, map_location=device)
+    checkpoint = _load_checkpoint(param_fp, device)
     state_dict = checkpoint['state_dict']
-    if all([param_name.startswith('model.') for param_name in state_dict.keys()]):
+    prefix = 'model.'
+    if all(param_name.startswith(prefix) for param_name in state_dict):
         # 表示导入的模型是通过 PlTrainer 训练出的 WrapperLightningModule，对其进行转化
-        state_dict = {}
-        for k, v in checkpoint['state_dict'].items():
-            state_dict[k.split('.', maxsplit=1)[1]] = v
+        state_dict = {k[len(prefix):]: v for k, v in state_dict.items()}
     model.load_state_dict(state_dict)
     return model
 
@@ -1,6 +1,19 @@
 # coding: utf-8
 
-from cnstd.utils.utils import sort_boxes
+import os
+import argparse
+import inspect
+import logging
+import re
+import time
+import hashlib
+import zipfile
+
+import pytest
+import torch
+
+from cnstd.utils import utils
+from cnstd.utils.utils import sort_boxes, check_sha1
 
 
 def four_to_eight(box):
@@ -19,3 +32,318 @@ def test_sort_boxes():
     boxes = [{'box': four_to_eight(box)} for box in boxes]
     out = sort_boxes(boxes, key='box')
     print(out)
+
+
+@pytest.mark.parametrize('content', [b'cnstd' * 100000, b''], ids=['data', 'empty'])
+@pytest.mark.parametrize('branch', ['mmap', 'file_digest', 'readinto', 'chunk_size'])
+def test_check_sha1(tmp_path, monkeypatch, branch, content):
+    monkeypatch.delenv('CNSTD_HASH_CHUNK', raising=False)
+    chunk_size = None
+    if branch == 'mmap':
+        monkeypatch.setattr(utils, '_available_memory', lambda: 1 << 40)
+    elif branch == 'chunk_size':
+        # an explicit chunk size always takes the chunked path
+        monkeypatch.setattr(utils, '_available_memory', lambda: 1 << 40)
+        chunk_size = 4099
+    else:
+        monkeypatch.setattr(utils, '_available_memory', lambda: 0)
+        if branch == 'readinto':
+            monkeypatch.delattr(hashlib, 'file_digest', raising=False)
+        elif not hasattr(hashlib, 'file_digest'):
+            pytest.skip('hashlib.file_digest requires Python >= 3.11')
+    fp = tmp_path / 'model.zip'
+    fp.write_bytes(content)
+    sha1_hash = hashlib.sha1(content).hexdigest()
+    assert check_sha1(str(fp), sha1_hash, chunk_size)
+    assert check_sha1(str(fp), sha1_hash[:8], chunk_size)
+    assert not check_sha1(str(fp), '0' * 40, chunk_size)
+
+
+def test_check_sha1_cache(tmp_path, monkeypatch):
+    calls = []
+    ori_check_sha1 = utils.check_sha1
+
+    def counting_check_sha1(*args, **kwargs):
+        calls.append(args)
+        return ori_check_sha1(*args, **kwargs)
+
+    monkeypatch.setattr(utils, 'check_sha1', counting_check_sha1)
+    utils._check_sha1_cached.cache_clear()
+    fp = str(tmp_path / 'model.zip')
+    with open(fp, 'wb') as f:
+        f.write(b'cnstd-v1')
+    hash1 = hashlib.sha1(b'cnstd-v1').hexdigest()
+    assert utils._check_sha1_if_changed(fp, hash1)
+    assert utils._check_sha1_if_changed(fp, hash1)
+    assert len(calls) == 1  # unchanged file is hashed only once
+
+    # same size and mtime, as `shutil.copy2` would leave them
+    st = os.stat(fp)
+    other_fp = str(tmp_path / 'other.zip')
+    with open(other_fp, 'wb') as f:
+        f.write(b'cnstd-v2')
+    os.utime(other_fp, ns=(st.st_atime_ns, st.st_mtime_ns))
+    os.replace(other_fp, fp)
+    assert not utils._check_sha1_if_changed(fp, hash1)
+    assert len(calls) == 2
+    utils._check_sha1_cached.cache_clear()
+
+
+@pytest.mark.parametrize('env_value', ['0', '-1', 'abc'])
+def test_invalid_io_chunk_size(tmp_path, monkeypatch, env_value):
+    fp = tmp_path / 'model.zip'
+    fp.write_bytes(b'cnstd')
+    monkeypatch.setenv('CNSTD_HASH_CHUNK', env_value)
+    with pytest.raises(ValueError):
+        check_sha1(str(fp), hashlib.sha1(b'cnstd').hexdigest())
+    monkeypatch.delenv('CNSTD_HASH_CHUNK')
+    with pytest.raises(ValueError):
+        check_sha1(str(fp), hashlib.sha1(b'cnstd').hexdigest(), chunk_size=0)
+
+    monkeypatch.setenv('CNSTD_IO_CHUNK', env_value)
+    url = {'cn_oss': 'http://x/', 'filename': 'model.zip'}
+    with pytest.raises(ValueError):
+        utils.download(url, path=str(tmp_path), overwrite=True)
+
+
+def test_io_chunk_size_does_not_affect_hashing(tmp_path, monkeypatch):
+    # tuning the HTTP chunk size must keep the fast (mmap) hashing path
+    monkeypatch.setenv('CNSTD_IO_CHUNK', '1024')
+    monkeypatch.delenv('CNSTD_HASH_CHUNK', raising=False)
+    monkeypatch.setattr(utils, '_available_memory', lambda: 1 << 40)
+
+    def fail_chunk_size(*args, **kwargs):
+        raise AssertionError('check_sha1 should not hash chunk by chunk')
+
+    monkeypatch.setattr(utils, '_io_chunk_size', fail_chunk_size)
+    fp = tmp_path / 'model.zip'
+    fp.write_bytes(b'cnstd')
+    assert check_sha1(str(fp), hashlib.sha1(b'cnstd').hexdigest())
+
+
+class _FakeResponse(object):
+    def __init__(self, status_code, content, headers=None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers or {}
+
+    def iter_content(self, chunk_size):
+        for start in range(0, len(self.content), chunk_size):
+            yield self.content[start : start + chunk_size]
+
+
+def _fake_ranged_get(content, status_code=206, short=False, slow_first=False):
+    def get(url, headers=None, stream=False):
+        if not headers or 'Range' not in headers:
+            return _FakeResponse(
+                200, content, {'content-length': str(len(content))}
+            )
+        lo, hi = map(int, re.match(r'bytes=(\d+)-(\d+)', headers['Range']).groups())
+        if slow_first and lo == 0:
+            time.sleep(2)
+        elif slow_first and hi == len(content) - 1:
+            return _FakeResponse(500, b'')
+        part = content[lo : hi + 1]
+        if short and lo > 0:
+            part = part[:-1]
+        return _FakeResponse(status_code, part)
+
+    return get
+
+
+def _wait_for_files(dir_path, expected, timeout=5):
+    # a failed ranged download may remove its temporary file in the background
+    deadline = time.time() + timeout
+    while sorted(os.listdir(dir_path)) != expected and time.time() < deadline:
+        time.sleep(0.05)
+    return sorted(os.listdir(dir_path))
+
+
+def test_ranged_download(tmp_path, monkeypatch):
+    content = os.urandom(100003)
+    fp = str(tmp_path / 'model.zip')
+    monkeypatch.setattr(utils.requests, 'get', _fake_ranged_get(content))
+    utils._ranged_download('http://x/model.zip', fp, len(content), chunk_size=4096, n=8)
+    with open(fp, 'rb') as f:
+        assert f.read() == content
+    assert os.listdir(str(tmp_path)) == ['model.zip']
+
+
+def test_download_with_ranges(tmp_path, monkeypatch):
+    content = os.urandom(100003)
+    headers = {'content-length': str(len(content)), 'accept-ranges': 'bytes'}
+    monkeypatch.setattr(
+        utils.requests, 'head', lambda url, **kwargs: _FakeResponse(200, b'', headers)
+    )
+    monkeypatch.setattr(utils.requests, 'get', _fake_ranged_get(content))
+    url = {'cn_oss': 'http://x/', 'filename': 'model.zip'}
+    fp = utils.download(
+        url, path=str(tmp_path), sha1_hash=hashlib.sha1(content).hexdigest()
+    )
+    with open(fp, 'rb') as f:
+        assert f.read() == content
+
+
+def test_download_hashes_single_stream(tmp_path, monkeypatch):
+    content = os.urandom(100003)
+    headers = {'content-length': str(len(content))}  # no `accept-ranges`
+    monkeypatch.setattr(
+        utils.requests, 'head', lambda url, **kwargs: _FakeResponse(200, b'', headers)
+    )
+    monkeypatch.setattr(utils.requests, 'get', _fake_ranged_get(content))
+
+    def fail_check_sha1(*args, **kwargs):
+        raise AssertionError('the downloaded file should not be hashed again')
+
+    monkeypatch.setattr(utils, 'check_sha1', fail_check_sha1)
+    url = {'cn_oss': 'http://x/', 'filename': 'model.zip'}
+    fp = utils.download(
+        url, path=str(tmp_path), sha1_hash=hashlib.sha1(content).hexdigest()
+    )
+    with open(fp, 'rb') as f:
+        assert f.read() == content
+    with pytest.raises(UserWarning):
+        utils.download(url, path=str(tmp_path), overwrite=True, sha1_hash='0' * 40)
+
+
+@pytest.mark.parametrize('failure', ['head-error', 'range-ignored'])
+def test_download_falls_back_to_single_stream(tmp_path, monkeypatch, failure):
+    content = os.urandom(100003)
+    headers = {'content-length': str(len(content)), 'accept-ranges': 'bytes'}
+
+    def head(url, **kwargs):
+        if failure == 'head-error':
+            raise utils.requests.ConnectionError('connection reset')
+        return _FakeResponse(200, b'', headers)
+
+    monkeypatch.setattr(utils.requests, 'head', head)
+    # a proxy answering ranged requests with the whole body (200)
+    monkeypatch.setattr(
+        utils.requests, 'get', _fake_ranged_get(content, status_code=200)
+    )
+    url = {'cn_oss': 'http://x/', 'filename': 'model.zip'}
+    fp = utils.download(
+        url, path=str(tmp_path), sha1_hash=hashlib.sha1(content).hexdigest()
+    )
+    with open(fp, 'rb') as f:
+        assert f.read() == content
+    assert _wait_for_files(str(tmp_path), ['model.zip']) == ['model.zip']
+
+
+@pytest.mark.parametrize(
+    'status_code, short', [(200, False), (206, True)], ids=['not-206', 'short-range']
+)
+def test_ranged_download_failure(tmp_path, monkeypatch, status_code, short):
+    content = os.urandom(100003)
+    fp = str(tmp_path / 'model.zip')
+    monkeypatch.setattr(
+        utils.requests, 'get', _fake_ranged_get(content, status_code, short)
+    )
+    with pytest.raises(RuntimeError):
+        utils._ranged_download(
+            'http://x/model.zip', fp, len(content), chunk_size=4096, n=8
+        )
+    # neither the target nor a partial file is left behind
+    assert _wait_for_files(str(tmp_path), []) == []
+
+
+def test_ranged_download_fails_fast(tmp_path, monkeypatch):
+    content = os.urandom(100003)
+    fp = str(tmp_path / 'model.zip')
+    # the last range fails at once, while the first one is still slow
+    monkeypatch.setattr(
+        utils.requests, 'get', _fake_ranged_get(content, slow_first=True)
+    )
+    start = time.time()
+    with pytest.raises(RuntimeError):
+        utils._ranged_download(
+            'http://x/model.zip', fp, len(content), chunk_size=4096, n=8
+        )
+    assert time.time() - start < 1
+    assert _wait_for_files(str(tmp_path), []) == []
+
+
+def _read_tree(root):
+    tree = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        rel_dir = os.path.relpath(dirpath, root)
+        tree[rel_dir] = None
+        for fn in filenames:
+            with open(os.path.join(dirpath, fn), 'rb') as f:
+                tree[os.path.join(rel_dir, fn)] = f.read()
+    return tree
+
+
+def test_extract_zip(tmp_path):
+    zip_fp = str(tmp_path / 'model.zip')
+    with zipfile.ZipFile(zip_fp, 'w', zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr('model/', b'')
+        zf.writestr('model/empty/', b'')
+        zf.writestr('model/config.json', b'{}')
+        for i in range(10):
+            zf.writestr('model/weights/part-%d.bin' % i, os.urandom(50000))
+    expected_dir = tmp_path / 'expected'
+    with zipfile.ZipFile(zip_fp) as zf:
+        zf.extractall(str(expected_dir))
+
+    out_dir = tmp_path / 'out'
+    utils._extract_zip(zip_fp, str(out_dir))
+    assert _read_tree(str(out_dir)) == _read_tree(str(expected_dir))
+
+
+@pytest.fixture
+def torch_load_calls(monkeypatch):
+    calls = []
+    ori_load = torch.load
+
+    def load(*args, **kwargs):
+        calls.append({k: v for k, v in kwargs.items() if k != 'map_location'})
+        return ori_load(*args, **kwargs)
+
+    monkeypatch.setattr(utils.torch, 'load', load)
+    return calls
+
+
+@pytest.mark.skipif(
+    'mmap' not in inspect.signature(torch.load).parameters,
+    reason='torch.load(mmap=...) requires torch >= 2.1',
+)
+@pytest.mark.parametrize('case', ['plain', 'objects', 'legacy', 'truncated'])
+def test_load_model_params(tmp_path, caplog, torch_load_calls, case):
+    model = torch.nn.Linear(3, 2)
+    state_dict = {'model.' + k: v for k, v in model.state_dict().items()}
+    fp = str(tmp_path / 'model.ckpt')
+    if case == 'objects':
+        # like the hyper-parameters stored by pytorch-lightning
+        checkpoint = {'state_dict': state_dict, 'hparams': argparse.Namespace(lr=0.1)}
+        torch.save(checkpoint, fp)
+    elif case == 'legacy':
+        torch.save({'state_dict': state_dict}, fp, _use_new_zipfile_serialization=False)
+    else:
+        torch.save({'state_dict': state_dict}, fp)
+    if case == 'truncated':
+        with open(fp, 'rb') as f:
+            content = f.read()
+        with open(fp, 'wb') as f:
+            f.write(content[: len(content) // 2])
+
+    new_model = torch.nn.Linear(3, 2)
+    with caplog.at_level(logging.WARNING):
+        if case == 'truncated':
+            with pytest.raises(RuntimeError):
+                utils.load_model_params(new_model, fp)
+        else:
+            utils.load_model_params(new_model, fp)
+            assert torch.equal(new_model.weight, model.weight)
+
+    expected_calls = {
+        'plain': [{'mmap': True, 'weights_only': True}],
+        'objects': [
+            {'mmap': True, 'weights_only': True},
+            {'mmap': True, 'weights_only': False},
+        ],
+        'legacy': [{'mmap': True, 'weights_only': True}, {'weights_only': True}],
+        'truncated': [{'mmap': True, 'weights_only': True}],
+    }
+    assert torch_load_calls == expected_calls[case]
+    assert ('weights_only=False' in caplog.text) == (case == 'objects')